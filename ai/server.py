@@ -5,10 +5,59 @@ Falls back to template-based generation if no model is available.
 """
 
 import os
+import re
 import json
 import sys
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs
+import time
+import queue
+import atexit
+import socket
+import sqlite3
+import hashlib
+import importlib.util
+import logging
+import logging.handlers
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Model dependencies are optional; without them the server runs in template mode
+try:
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
+    _HAS_TORCH = True
+except ImportError:
+    _HAS_TORCH = False
+
+try:
+    import orjson
+    _dumps = orjson.dumps  # returns UTF-8 bytes
+    _loads = orjson.loads
+
+    def _dumps_sorted(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+except ImportError:
+    # Reused encoders in orjson's output format: compact, non-ASCII left as UTF-8
+    _encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+    _encode_sorted = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), sort_keys=True).encode
+    # json.loads accepts lone surrogates ("\ud800") that can't be written as UTF-8;
+    # those payloads are escaped instead
+    _encode_ascii = json.JSONEncoder(separators=(",", ":")).encode
+    _encode_ascii_sorted = json.JSONEncoder(separators=(",", ":"), sort_keys=True).encode
+
+    def _dumps(obj):
+        try:
+            return _encode(obj).encode("utf-8")
+        except UnicodeEncodeError:
+            return _encode_ascii(obj).encode("ascii")
+    _loads = json.loads
+
+    def _dumps_sorted(obj):
+        try:
+            return _encode_sorted(obj).encode("utf-8")
+        except UnicodeEncodeError:
+            return _encode_ascii_sorted(obj).encode("ascii")
 
 # ============================================
 # Configuration
@@ -16,15 +65,55 @@ from urllib.parse import urlparse, parse_qs
 PORT = 5000
 MODEL_PATH = os.environ.get("SRED_MODEL_PATH", "./ai/output/sred-mistral-7b-qlora/merged")
 USE_GPU = os.environ.get("SRED_USE_GPU", "true").lower() == "true"
-FEEDBACK_FILE = os.environ.get("SRED_FEEDBACK_FILE", "./ai/dataset/feedback.jsonl")
+QUANT_MODES = ("fp16", "bf16", "int8", "nf4")
+QUANT = os.environ.get("SRED_QUANT", "fp16").lower()  # one of QUANT_MODES
+BACKEND = os.environ.get("SRED_BACKEND", "auto").lower()  # auto, vllm or transformers
+FEEDBACK_DB = os.environ.get("SRED_FEEDBACK_DB", "./ai/dataset/feedback.db")
+FEEDBACK_FILE = os.environ.get("SRED_FEEDBACK_FILE", "./ai/dataset/feedback.jsonl")  # legacy log, imported once into FEEDBACK_DB
 DPO_FILE = os.environ.get("SRED_DPO_FILE", "./ai/dataset/sred_dpo_feedback.jsonl")
 SFT_FILE = os.environ.get("SRED_SFT_FILE", "./ai/dataset/sred_sft_feedback.jsonl")
+USE_COMPILE = os.environ.get("SRED_COMPILE", "true").lower() == "true"
+KV_CACHE_LEN = int(os.environ.get("SRED_KV_CACHE_LEN", "4096"))  # 0 disables the static KV cache
+BATCH_SIZE = int(os.environ.get("SRED_BATCH_SIZE", "8"))
+BATCH_WAIT = 0.01  # seconds to wait for more requests to join a batch
+RESPONSE_CACHE_SIZE = int(os.environ.get("SRED_RESPONSE_CACHE_SIZE", "512"))
+MAX_BODY_BYTES = int(os.environ.get("SRED_MAX_BODY_BYTES", str(10 * 1024 * 1024)))
+WORKERS = max(1, int(os.environ.get("SRED_WORKERS", "1")))  # server processes sharing PORT (template mode; needs fork + SO_REUSEPORT)
+
+# Request-path logging goes through a queue; a listener thread does the stdout writes
+logger = logging.getLogger("sred")
+_log_listener = None
+
+
+def setup_logging():
+    """Attach the queue handler to the "sred" logger and start the writer thread."""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    log_queue = queue.Queue(-1)
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(message)s"))
+    _log_listener = logging.handlers.QueueListener(log_queue, stream)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
 
 # ============================================
 # Model Loading (lazy - only when needed)
 # ============================================
 model = None
 tokenizer = None
+kv_cache = None
+eager_forward = None  # model.forward before torch.compile, to fall back on
+llm = None  # vLLM engine, when that backend is in use
+# Chat template rendered around the user turn, so requests skip the Jinja render
+prompt_prefix_text = None  # system turn + user role-open
+prompt_suffix_text = None  # user role-close + assistant role-open
+prompt_prefix_ids = None
+prompt_suffix_ids = None
 model_loaded = False
 model_error = None
 
@@ -33,15 +122,21 @@ SYSTEM_PROMPT = """You are an expert SR&ED (Scientific Research and Experimental
 
 def load_model():
     """Load the fine-tuned model. Returns True if successful."""
-    global model, tokenizer, model_loaded, model_error
+    global model, tokenizer, kv_cache, eager_forward, llm, model_loaded, model_error, QUANT
 
     if model_loaded:
         return True
 
-    try:
-        from transformers import AutoModelForCausalLM, AutoTokenizer
-        import torch
+    if QUANT not in QUANT_MODES:
+        print(f"WARNING: Unknown SRED_QUANT={QUANT!r} (expected {', '.join(QUANT_MODES)}), using fp16")
+        QUANT = "fp16"
 
+    if not _HAS_TORCH:
+        model_error = "transformers/torch not installed. Install with: pip install torch transformers"
+        print(f"WARNING: {model_error}")
+        return False
+
+    try:
         print(f"Loading model from {MODEL_PATH}...")
 
         if not os.path.exists(MODEL_PATH):
@@ -49,7 +144,45 @@ def load_model():
             print(f"WARNING: {model_error}")
             return False
 
+        # Prefer vLLM (paged KV cache + continuous batching) when it is installed.
+        # int8/nf4 need bitsandbytes loading, which only the transformers path does.
+        use_vllm = BACKEND != "transformers" and USE_GPU and torch.cuda.is_available()
+        if use_vllm and QUANT in ("int8", "nf4"):
+            if BACKEND == "vllm":
+                print(f"WARNING: SRED_QUANT={QUANT} is not supported with vLLM, using transformers")
+            use_vllm = False
+        if use_vllm:
+            try:
+                from vllm import LLM
+                llm = LLM(
+                    model=MODEL_PATH,
+                    dtype="bfloat16" if QUANT == "bf16" else "float16",
+                    gpu_memory_utilization=0.9,
+                    trust_remote_code=True,
+                    enable_prefix_caching=True,
+                )
+                tokenizer = llm.get_tokenizer()
+                _split_chat_template()
+                model_loaded = True
+                clear_response_cache()
+                print("Model loaded successfully with vLLM!")
+                return True
+            except ImportError:
+                if BACKEND == "vllm":
+                    print("WARNING: vLLM not installed, falling back to transformers")
+            except Exception as e:
+                # e.g. not enough GPU memory for the engine; the transformers path may still fit
+                llm = tokenizer = None
+                torch.cuda.empty_cache()
+                print(f"WARNING: vLLM failed to start, falling back to transformers: {e}")
+
         tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
+        # Left padding so every row in a batch ends where generation starts
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+
+        _split_chat_template()
 
         load_kwargs = {
             "trust_remote_code": True,
@@ -59,18 +192,76 @@ def load_model():
         if USE_GPU and torch.cuda.is_available():
             load_kwargs["device_map"] = "auto"
             print(f"Loading on GPU: {torch.cuda.get_device_name(0)}")
+
+            # FlashAttention-2 rejects the static KV cache below, so it is only used without one
+            if KV_CACHE_LEN <= 0 and importlib.util.find_spec("flash_attn") is not None:
+                load_kwargs["attn_implementation"] = "flash_attention_2"
+            else:
+                load_kwargs["attn_implementation"] = "sdpa"
+            print(f"Attention: {load_kwargs['attn_implementation']}")
+
+            if QUANT == "bf16":
+                load_kwargs["torch_dtype"] = torch.bfloat16
+            elif QUANT in ("int8", "nf4"):
+                from transformers import BitsAndBytesConfig
+                if QUANT == "int8":
+                    load_kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
+                else:
+                    load_kwargs["torch_dtype"] = torch.bfloat16
+                    load_kwargs["quantization_config"] = BitsAndBytesConfig(
+                        load_in_4bit=True,
+                        bnb_4bit_quant_type="nf4",
+                        bnb_4bit_compute_dtype=torch.bfloat16,
+                        bnb_4bit_use_double_quant=True,
+                    )
+                    # bitsandbytes 4-bit ops cause graph breaks; let dynamo fall back on them
+                    torch._dynamo.config.suppress_errors = True
+            print(f"Weights: {QUANT}")
         else:
             load_kwargs["device_map"] = "cpu"
             print("Loading on CPU (slower inference)")
 
         model = AutoModelForCausalLM.from_pretrained(MODEL_PATH, **load_kwargs)
         model.eval()
+
+        # Compile the forward pass so decode steps run as fused kernels.
+        # dynamic=True because prompt length varies with the project payload.
+        if USE_COMPILE and hasattr(torch, "compile"):
+            try:
+                if torch.cuda.is_available():
+                    # With the fixed-shape StaticCache below, reduce-overhead mode can
+                    # capture and replay a CUDA graph per decode step
+                    torch._inductor.config.triton.cudagraph_trees = True
+                eager_forward = model.forward
+                model.forward = torch.compile(model.forward, mode="reduce-overhead", dynamic=True, fullgraph=False)
+                print("Model forward compiled with torch.compile")
+            except Exception as e:
+                print(f"WARNING: torch.compile failed, running eager: {e}")
+
+        # Pre-allocate one KV cache and reuse it across requests
+        kv_cache = None
+        if KV_CACHE_LEN > 0:
+            try:
+                from transformers import StaticCache
+                kv_cache = StaticCache(
+                    config=model.config,
+                    max_batch_size=1,
+                    max_cache_len=KV_CACHE_LEN,
+                    device=model.device,
+                    dtype=model.dtype,
+                )
+                print(f"Static KV cache allocated ({KV_CACHE_LEN} tokens)")
+            except Exception as e:
+                print(f"WARNING: StaticCache unavailable, using dynamic cache: {e}")
+
         model_loaded = True
+        clear_response_cache()
         print("Model loaded successfully!")
         return True
 
-    except ImportError:
-        model_error = "transformers/torch not installed. Install with: pip install torch transformers"
+    except ImportError as e:
+        # e.g. SRED_QUANT=nf4 without bitsandbytes installed
+        model_error = f"Missing model dependency: {e}"
         print(f"WARNING: {model_error}")
         return False
     except Exception as e:
@@ -79,138 +270,441 @@ def load_model():
         return False
 
 
+def _render_chat(prompt):
+    """Apply the chat template to the system prompt plus one user turn."""
+    return tokenizer.apply_chat_template(
+        [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt},
+        ],
+        tokenize=False,
+        add_generation_prompt=True,
+    )
+
+
+def _split_chat_template():
+    """Render the chat template once around a placeholder and cache the text/ids on either side."""
+    global prompt_prefix_text, prompt_suffix_text, prompt_prefix_ids, prompt_suffix_ids
+    prompt_prefix_text = prompt_suffix_text = prompt_prefix_ids = prompt_suffix_ids = None
+
+    placeholder = "<<<>>>"
+    try:
+        parts = _render_chat(placeholder).split(placeholder)
+        if len(parts) != 2:
+            return
+        prefix, suffix = parts
+        # Make sure the template inserts user content verbatim (no trimming etc.)
+        probe = "probe text\n"
+        if _render_chat(probe) != prefix + probe + suffix:
+            return
+    except Exception:
+        return
+
+    prompt_prefix_text, prompt_suffix_text = prefix, suffix
+
+    # Splicing ids is only safe if it reproduces tokenizing the whole prompt; SentencePiece
+    # tokenizers, for one, add a leading "▁" when the user text is encoded on its own
+    try:
+        prefix_ids = tokenizer(prefix)["input_ids"]
+        suffix_ids = tokenizer(suffix, add_special_tokens=False)["input_ids"]
+        probe_ids = tokenizer(probe, add_special_tokens=False)["input_ids"]
+        if prefix_ids + probe_ids + suffix_ids != tokenizer(_render_chat(probe))["input_ids"]:
+            return
+    except Exception:
+        return
+    prompt_prefix_ids, prompt_suffix_ids = prefix_ids, suffix_ids
+
+
 def generate_with_model(prompt, max_tokens=2048, temperature=0.7):
     """Generate text using the loaded model."""
-    import torch
+    return generate_batch_with_model([prompt], max_tokens=max_tokens, temperature=temperature)[0]
 
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "user", "content": prompt},
-    ]
 
-    input_text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    inputs = tokenizer(input_text, return_tensors="pt").to(model.device)
+def generate_batch_with_model(prompts, max_tokens=2048, temperature=0.7, streamer=None):
+    """Generate text for several prompts in a single padded model.generate call.
+
+    If a streamer is given (single prompt only), decoded text is also pushed to it as it is produced.
+    """
+    if llm is not None:
+        from vllm import SamplingParams
+        params = SamplingParams(
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=0.9,
+            repetition_penalty=1.1,
+        )
+        if prompt_prefix_text is not None:
+            input_texts = [prompt_prefix_text + prompt + prompt_suffix_text for prompt in prompts]
+        else:
+            input_texts = [_render_chat(prompt) for prompt in prompts]
+        texts = [out.outputs[0].text.strip() for out in llm.generate(input_texts, params)]
+        if streamer is not None:
+            # The offline vLLM engine returns whole completions; hand it over in one piece
+            streamer.on_finalized_text(texts[0], stream_end=True)
+        return texts
+
+    if prompt_prefix_ids is not None:
+        # Only the user text is tokenized per request
+        user_ids = tokenizer(list(prompts), add_special_tokens=False)["input_ids"]
+        input_ids = [prompt_prefix_ids + ids + prompt_suffix_ids for ids in user_ids]
+        inputs = tokenizer.pad({"input_ids": input_ids}, return_tensors="pt").to(model.device)
+    else:
+        input_texts = [_render_chat(prompt) for prompt in prompts]
+        inputs = tokenizer(input_texts, return_tensors="pt", padding=True).to(model.device)
+    prompt_len = inputs["input_ids"].shape[1]
+
+    # The static cache is sized for a single sequence
+    cache_kwargs = {}
+    if kv_cache is not None and len(prompts) == 1 and prompt_len + max_tokens <= KV_CACHE_LEN:
+        kv_cache.reset()
+        cache_kwargs = {"past_key_values": kv_cache, "use_cache": True}
+
+    # temperature=0 means greedy decoding; HF rejects it when sampling
+    if temperature > 0:
+        sampling_kwargs = {"do_sample": True, "temperature": temperature, "top_p": 0.9}
+    else:
+        sampling_kwargs = {"do_sample": False}
 
     with torch.no_grad():
         outputs = model.generate(
             **inputs,
+            **cache_kwargs,
+            **sampling_kwargs,
             max_new_tokens=max_tokens,
-            temperature=temperature,
-            top_p=0.9,
-            do_sample=True,
             repetition_penalty=1.1,
-            pad_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+            streamer=streamer,
         )
 
-    response = tokenizer.decode(outputs[0][inputs["input_ids"].shape[1]:], skip_special_tokens=True)
-    return response.strip()
+    # Prompts are left-padded, so generated tokens start at prompt_len in every row.
+    # Slice on device and copy only the new tokens to the host in one transfer.
+    new_tokens = outputs[:, prompt_len:].tolist()
+    return [text.strip() for text in tokenizer.batch_decode(new_tokens, skip_special_tokens=True)]
+
+
+# ============================================
+# Request batching
+# ============================================
+
+_generate_queue = queue.Queue()
+_batch_worker = None
+_batch_worker_lock = threading.Lock()
+# Bounds how many request threads can wait on the model at once
+_GPU_SEM = threading.BoundedSemaphore(BATCH_SIZE)
+
+
+def _run_batch_worker():
+    """Collect queued prompts into batches and run them through the model."""
+    while True:
+        batch = [_generate_queue.get()]
+        deadline = time.monotonic() + BATCH_WAIT
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_generate_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        # Never let one bad batch kill the worker: every waiting request would hang
+        try:
+            _run_batch(batch)
+        except Exception as e:
+            for _, _, _, future, streamer in batch:
+                if not future.done():
+                    if streamer is not None:
+                        streamer.on_finalized_text("", stream_end=True)
+                    future.set_exception(e)
+
+
+def _run_batch(batch):
+    # Only requests with the same sampling settings can share a generate call.
+    # Streamed requests carry their own streamer, so each runs on its own.
+    groups = {}
+    for prompt, max_tokens, temperature, future, streamer in batch:
+        groups.setdefault((max_tokens, temperature, streamer), []).append((prompt, future))
+
+    for (max_tokens, temperature, streamer), items in groups.items():
+        try:
+            texts = generate_batch_with_model(
+                [prompt for prompt, _ in items],
+                max_tokens=max_tokens,
+                temperature=temperature,
+                streamer=streamer,
+            )
+            for (_, future), text in zip(items, texts):
+                future.set_result(text)
+        except Exception as e:
+            if streamer is not None:
+                streamer.on_finalized_text("", stream_end=True)
+            for _, future in items:
+                future.set_exception(e)
+
+
+def start_batch_worker():
+    """Start the background batching thread (once)."""
+    global _batch_worker
+    with _batch_worker_lock:
+        if _batch_worker is None:
+            _batch_worker = threading.Thread(target=_run_batch_worker, name="sred-batcher", daemon=True)
+            _batch_worker.start()
+
+
+def submit_generation(prompt, max_tokens=2048, temperature=0.7):
+    """Queue a prompt for batched generation and wait for its result."""
+    # Validate here so a malformed request fails in its own thread, not in the worker
+    max_tokens, temperature = int(max_tokens), float(temperature)
+    start_batch_worker()
+    with _GPU_SEM:
+        future = Future()
+        _generate_queue.put((prompt, max_tokens, temperature, future, None))
+        return future.result()
+
+
+def submit_stream(prompt, max_tokens=2048, temperature=0.7):
+    """Queue a prompt for generation; returns an iterator of text chunks as they are decoded."""
+    # Checked before the generator starts, so errors surface before any response headers
+    max_tokens, temperature = int(max_tokens), float(temperature)
+    return _stream_generation(prompt, max_tokens, temperature)
+
+
+def _stream_generation(prompt, max_tokens, temperature):
+    start_batch_worker()
+    with _GPU_SEM:
+        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        future = Future()
+        _generate_queue.put((prompt, max_tokens, temperature, future, streamer))
+        yield from streamer
+        future.result()  # re-raise any generation error
+
+
+def _drop_static_cache():
+    global kv_cache
+    kv_cache = None
+
+
+def _drop_compile():
+    global eager_forward
+    model.forward = eager_forward
+    eager_forward = None
+
+
+def warm_up_model():
+    """Run short generations on the batch worker before serving. Returns True if the model works.
+
+    If warmup fails, the static KV cache and then torch.compile are switched off and it is
+    retried; if the model still fails it is unloaded so requests fall back to templates.
+    """
+    global model, llm, kv_cache, model_loaded, model_error
+    fallbacks = []
+    if kv_cache is not None:
+        fallbacks.append(("the static KV cache", _drop_static_cache))
+    if eager_forward is not None:
+        fallbacks.append(("torch.compile", _drop_compile))
+
+    start_batch_worker()
+    while True:
+        try:
+            # Pay the compile cost up front instead of on the first real request.
+            # The second call runs with the same shapes so CUDA graphs are captured.
+            for _ in range(2):
+                submit_generation("warmup", max_tokens=8)
+            return True
+        except Exception as e:
+            if not fallbacks:
+                model_error = f"Model warmup failed: {e}"
+                break
+            name, disable = fallbacks.pop(0)
+            print(f"WARNING: warmup failed ({e}); retrying without {name}")
+            disable()
+
+    print(f"ERROR: {model_error}")
+    model_loaded = False
+    model = llm = kv_cache = None
+    if _HAS_TORCH and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return False
+
+
+# ============================================
+# Response cache
+# ============================================
+
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+
+def _response_cache_key(data):
+    """Hash of the canonicalized request, so key order doesn't matter."""
+    return hashlib.blake2b(_dumps_sorted(data), digest_size=16).hexdigest()
+
+
+def get_cached_response(key):
+    """Return a copy of the cached sections for key, or None."""
+    with _response_cache_lock:
+        sections = _response_cache.get(key)
+        if sections is None:
+            return None
+        _response_cache.move_to_end(key)
+        return dict(sections)
+
+
+def put_cached_response(key, sections):
+    """Store sections for key, evicting the least recently used entry when full."""
+    with _response_cache_lock:
+        _response_cache[key] = dict(sections)
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+
+def clear_response_cache():
+    """Drop all cached responses (e.g. after a model reload)."""
+    with _response_cache_lock:
+        _response_cache.clear()
 
 
 # ============================================
 # Template-based fallback generation
 # ============================================
 
+_HEADING_242 = "LINE 242 - SCIENTIFIC OR TECHNOLOGICAL ADVANCEMENT\n\n"
+_HEADING_244 = "LINE 244 - SCIENTIFIC OR TECHNOLOGICAL UNCERTAINTY\n\n"
+_HEADING_246 = "LINE 246 - WORK PERFORMED\n\n"
+_INTRO_244 = "At the commencement of this project, the following technological uncertainties existed that could not be resolved by a competent professional in the field using standard practice, publicly available knowledge, or existing technical literature:\n\n"
+_CLOSING_246 = "The work described above constitutes a systematic investigation carried out in a field of science or technology by means of experiment or analysis."
+
+# Project fields used by the templates, with their defaults (in unpack order)
+_TPL_FIELDS = (
+    ("title", "the project"),
+    ("field", "technology"),
+    ("objective", ""),
+    ("baseline", ""),
+    ("advancement", ""),
+    ("whyNotStandard", ""),
+    ("uncertainties", ""),
+    ("whyUncertain", ""),
+    ("hypotheses", ""),
+    ("experiments", ""),
+    ("iterations", ""),
+    ("results", ""),
+    ("personnel", ""),
+)
+
+# Non-blank input lines and the list markers stripped from them
+_LINES = re.compile(r"[^\n]*\S[^\n]*")
+_UNC_PREFIX = re.compile(r"^[ 0-9.\-)]+")
+_HYP_PREFIX = re.compile(r"^[ Hh0-9.\-):]+")
+_BULLET_PREFIX = re.compile(r"^[ \-•*]+")
+
+
 def generate_with_templates(data):
     """Generate T661 descriptions using structured templates when no AI model is available."""
 
     section = data.get("section", "all")
     project = data.get("project", {})
 
-    title = project.get("title", "the project")
-    field = project.get("field", "technology")
-    objective = project.get("objective", "")
-    baseline = project.get("baseline", "")
-    advancement = project.get("advancement", "")
-    why_not_standard = project.get("whyNotStandard", "")
-    uncertainties = project.get("uncertainties", "")
-    why_uncertain = project.get("whyUncertain", "")
-    hypotheses = project.get("hypotheses", "")
-    experiments = project.get("experiments", "")
-    iterations = project.get("iterations", "")
-    results = project.get("results", "")
-    personnel = project.get("personnel", "")
+    (title, field, objective, baseline, advancement, why_not_standard, uncertainties,
+     why_uncertain, hypotheses, experiments, iterations, results, personnel) = [
+        project.get(key, default) for key, default in _TPL_FIELDS
+    ]
 
     output = {}
 
     if section in ("all", "242"):
-        line242 = "LINE 242 - SCIENTIFIC OR TECHNOLOGICAL ADVANCEMENT\n\n"
+        p242 = [_HEADING_242]
 
         if objective:
-            line242 += f"The objective of this project was to achieve a technological advancement in the field of {field} through {objective.rstrip('.')}.\n\n"
+            p242.append(f"The objective of this project was to achieve a technological advancement in the field of {field} through {objective.rstrip('.')}.\n\n")
         else:
-            line242 += f"The objective of this project was to achieve a technological advancement in the field of {field}.\n\n"
+            p242.append(f"The objective of this project was to achieve a technological advancement in the field of {field}.\n\n")
 
         if baseline:
-            line242 += f"At the outset of this project, the state of technology was as follows: {baseline}\n\n"
+            p242.append(f"At the outset of this project, the state of technology was as follows: {baseline}\n\n")
 
         if advancement:
-            line242 += f"The technological advancement sought was {advancement.rstrip('.')}.\n\n"
+            p242.append(f"The technological advancement sought was {advancement.rstrip('.')}.\n\n")
 
         if why_not_standard:
-            line242 += f"This advancement could not be achieved through standard practice because {why_not_standard.rstrip('.')}. A competent professional in the field would not have been able to achieve this advancement using existing knowledge, publicly available information, or standard industry methodologies."
+            p242.append(f"This advancement could not be achieved through standard practice because {why_not_standard.rstrip('.')}. A competent professional in the field would not have been able to achieve this advancement using existing knowledge, publicly available information, or standard industry methodologies.")
 
-        output["line242"] = line242.strip()
+        output["line242"] = "".join(p242).strip()
 
     if section in ("all", "244"):
-        line244 = "LINE 244 - SCIENTIFIC OR TECHNOLOGICAL UNCERTAINTY\n\n"
-        line244 += "At the commencement of this project, the following technological uncertainties existed that could not be resolved by a competent professional in the field using standard practice, publicly available knowledge, or existing technical literature:\n\n"
+        p244 = [_HEADING_244, _INTRO_244]
 
         if uncertainties:
-            unc_lines = [u.strip() for u in uncertainties.split("\n") if u.strip()]
-            for i, u in enumerate(unc_lines, 1):
-                cleaned = u.lstrip("0123456789.-) ").strip()
-                if not cleaned.lower().startswith("it was uncertain"):
-                    cleaned = f"it was uncertain {cleaned}"
-                line244 += f"{i}. {cleaned[0].upper()}{cleaned[1:]}\n\n"
+            cleaned = []
+            for u in _LINES.findall(uncertainties):
+                c = _UNC_PREFIX.sub("", u.strip()).strip()
+                if not c[:16].lower().startswith("it was uncertain"):
+                    c = "it was uncertain " + c
+                cleaned.append(c[:1].upper() + c[1:])
+            if cleaned:
+                p244.append("\n\n".join(f"{i}. {c}" for i, c in enumerate(cleaned, 1)) + "\n\n")
 
         if why_uncertain:
-            line244 += f"These uncertainties could not be resolved by a competent professional through standard practice because {why_uncertain.rstrip('.')}.\n\n"
+            p244.append(f"These uncertainties could not be resolved by a competent professional through standard practice because {why_uncertain.rstrip('.')}.\n\n")
 
         if hypotheses:
-            line244 += "To address these uncertainties, the following hypotheses were formulated:\n\n"
-            hyp_lines = [h.strip() for h in hypotheses.split("\n") if h.strip()]
-            for i, h in enumerate(hyp_lines, 1):
-                cleaned = h.lstrip("Hh0123456789.-):) ").strip()
-                line244 += f"H{i}: {cleaned}\n"
+            p244.append("To address these uncertainties, the following hypotheses were formulated:\n\n")
+            cleaned = [_HYP_PREFIX.sub("", h.strip()).strip() for h in _LINES.findall(hypotheses)]
+            if cleaned:
+                p244.append("\n".join(f"H{i}: {c}" for i, c in enumerate(cleaned, 1)) + "\n")
 
-        output["line244"] = line244.strip()
+        output["line244"] = "".join(p244).strip()
 
     if section in ("all", "246"):
-        line246 = "LINE 246 - WORK PERFORMED\n\n"
+        p246 = [_HEADING_246]
 
         if personnel:
-            line246 += f"A systematic investigation was conducted by a team of {personnel} to address the technological uncertainties identified above.\n\n"
+            p246.append(f"A systematic investigation was conducted by a team of {personnel} to address the technological uncertainties identified above.\n\n")
         else:
-            line246 += "A systematic investigation was conducted to address the technological uncertainties identified above.\n\n"
+            p246.append("A systematic investigation was conducted to address the technological uncertainties identified above.\n\n")
 
         if experiments:
-            line246 += "The following experiments and tests were designed and performed as part of the systematic investigation:\n\n"
-            exp_lines = [e.strip() for e in experiments.split("\n") if e.strip()]
-            for e in exp_lines:
-                cleaned = e.lstrip("-•* ").strip()
-                line246 += f"• {cleaned}\n"
-            line246 += "\n"
+            p246.append("The following experiments and tests were designed and performed as part of the systematic investigation:\n\n")
+            cleaned = [_BULLET_PREFIX.sub("", e.strip()).strip() for e in _LINES.findall(experiments)]
+            if cleaned:
+                p246.append("\n".join(f"• {c}" for c in cleaned) + "\n")
+            p246.append("\n")
 
         if iterations:
-            line246 += "Based on experimental results, the following iterations and modifications were made:\n\n"
-            iter_lines = [i.strip() for i in iterations.split("\n") if i.strip()]
-            for it in iter_lines:
-                cleaned = it.lstrip("-•* ").strip()
-                line246 += f"• {cleaned}\n"
-            line246 += "\n"
+            p246.append("Based on experimental results, the following iterations and modifications were made:\n\n")
+            cleaned = [_BULLET_PREFIX.sub("", it.strip()).strip() for it in _LINES.findall(iterations)]
+            if cleaned:
+                p246.append("\n".join(f"• {c}" for c in cleaned) + "\n")
+            p246.append("\n")
 
         if results:
-            line246 += f"The systematic investigation yielded the following results and conclusions: {results}\n\n"
+            p246.append(f"The systematic investigation yielded the following results and conclusions: {results}\n\n")
 
-        line246 += "The work described above constitutes a systematic investigation carried out in a field of science or technology by means of experiment or analysis."
+        p246.append(_CLOSING_246)
 
-        output["line246"] = line246.strip()
+        output["line246"] = "".join(p246).strip()
 
     return output
 
 
-def generate_with_ai(data):
-    """Generate using the AI model with a structured prompt."""
+# Optional project fields included in the model prompt, with their labels
+_PROMPT_FIELDS = (
+    ("objective", "Objective"),
+    ("baseline", "Baseline Technology"),
+    ("advancement", "Advancement Sought"),
+    ("whyNotStandard", "Why Not Standard Practice"),
+    ("uncertainties", "Uncertainties"),
+    ("whyUncertain", "Why Uncertain"),
+    ("hypotheses", "Hypotheses"),
+    ("experiments", "Experiments"),
+    ("iterations", "Iterations"),
+    ("results", "Results"),
+    ("personnel", "Personnel"),
+)
+
+
+def build_generation_prompt(data):
+    """Build the model prompt for a /generate request."""
     section = data.get("section", "all")
     project = data.get("project", {})
 
@@ -225,115 +719,205 @@ def generate_with_ai(data):
     prompt += f"Project Title: {project.get('title', 'N/A')}\n"
     prompt += f"Industry: {project.get('field', 'N/A')}\n"
 
-    if project.get("objective"):
-        prompt += f"Objective: {project['objective']}\n"
-    if project.get("baseline"):
-        prompt += f"Baseline Technology: {project['baseline']}\n"
-    if project.get("advancement"):
-        prompt += f"Advancement Sought: {project['advancement']}\n"
-    if project.get("whyNotStandard"):
-        prompt += f"Why Not Standard Practice: {project['whyNotStandard']}\n"
-    if project.get("uncertainties"):
-        prompt += f"Uncertainties: {project['uncertainties']}\n"
-    if project.get("whyUncertain"):
-        prompt += f"Why Uncertain: {project['whyUncertain']}\n"
-    if project.get("hypotheses"):
-        prompt += f"Hypotheses: {project['hypotheses']}\n"
-    if project.get("experiments"):
-        prompt += f"Experiments: {project['experiments']}\n"
-    if project.get("iterations"):
-        prompt += f"Iterations: {project['iterations']}\n"
-    if project.get("results"):
-        prompt += f"Results: {project['results']}\n"
-    if project.get("personnel"):
-        prompt += f"Personnel: {project['personnel']}\n"
+    for key, label in _PROMPT_FIELDS:
+        value = project.get(key)
+        if value:
+            prompt += f"{label}: {value}\n"
+
+    return prompt
+
+
+def generate_with_ai(data):
+    """Generate using the AI model with a structured prompt."""
+    # Only deterministic (or explicitly cacheable) requests are memoized,
+    # so normal sampling still gives varied output
+    cacheable = data.get("temperature", 0.7) == 0 or data.get("cache") is True
+    if cacheable:
+        cache_key = _response_cache_key(data)
+        cached = get_cached_response(cache_key)
+        if cached is not None:
+            return cached
+
+    section = data.get("section", "all")
+    prompt = build_generation_prompt(data)
 
     max_tokens = data.get("max_tokens", 2048)
     temperature = data.get("temperature", 0.7)
 
-    response = generate_with_model(prompt, max_tokens=max_tokens, temperature=temperature)
+    response = submit_generation(prompt, max_tokens=max_tokens, temperature=temperature)
 
     # Try to split into sections if generating all
     output = {}
     if section == "all":
-        if "LINE 242" in response and "LINE 244" in response and "LINE 246" in response:
-            parts = response.split("LINE 244")
-            output["line242"] = parts[0].strip()
-            remaining = "LINE 244" + parts[1] if len(parts) > 1 else ""
-            parts2 = remaining.split("LINE 246")
-            output["line244"] = parts2[0].strip()
-            output["line246"] = ("LINE 246" + parts2[1]).strip() if len(parts2) > 1 else ""
+        i244 = response.find("LINE 244")
+        i246 = response.find("LINE 246", i244 + 1) if i244 >= 0 else -1
+        if i244 >= 0 and "LINE 242" in response and "LINE 246" in response:
+            output["line242"] = response[:i244].strip()
+            if i246 >= 0:
+                output["line244"] = response[i244:i246].strip()
+                output["line246"] = response[i246:].strip()
+            else:
+                output["line244"] = response[i244:].strip()
+                output["line246"] = ""
         else:
             output["line242"] = response
     else:
         output[f"line{section}"] = response
 
+    if cacheable:
+        put_cached_response(cache_key, output)
+
     return output
 
 
+# ============================================
+# Template-based improvement keywords
+# ============================================
+
+# Per section: (lowercase needles, suggestion shown when none of the needles occur)
+_IMPROVE_RULES = {
+    "242": (
+        (("technological advancement",), "Consider adding: 'The technological advancement sought was...'"),
+        (("standard practice", "competent professional"), "Consider adding: 'This could not be achieved through standard practice because...'"),
+        (("state of technology", "baseline"), "Consider adding: 'At the outset of this project, the state of technology was...'"),
+    ),
+    "244": (
+        (("it was uncertain",), "Frame uncertainties as: 'It was uncertain whether...'"),
+        (("competent professional",), "Add: 'A competent professional could not resolve these through standard practice because...'"),
+        (("hypothes",), "Consider adding hypotheses: 'H1: ...'"),
+    ),
+    "246": (
+        (("systematic",), "Add: 'A systematic investigation was conducted...'"),
+        (("experiment", "test"), "Describe specific experiments and tests performed"),
+        (("iteration", "modif"), "Describe iterations/modifications made based on results"),
+    ),
+}
+
+_IMPROVE_KEYWORDS = {
+    section: tuple(dict.fromkeys(n for needles, _ in rules for n in needles))
+    for section, rules in _IMPROVE_RULES.items()
+}
+
+# One Aho-Corasick automaton per section finds all of its keywords in a single pass
+try:
+    import ahocorasick
+
+    def _build_matcher(keywords):
+        automaton = ahocorasick.Automaton()
+        for keyword in keywords:
+            automaton.add_word(keyword, keyword)
+        automaton.make_automaton()
+        return automaton
+
+    _SECTION_MATCHERS = {section: _build_matcher(keywords) for section, keywords in _IMPROVE_KEYWORDS.items()}
+except ImportError:
+    _SECTION_MATCHERS = None
+
+
+def _find_improve_keywords(text_lower, section):
+    """Return the set of the section's improvement keywords that occur in text_lower."""
+    if _SECTION_MATCHERS is not None:
+        matcher = _SECTION_MATCHERS.get(section)
+        return {keyword for _, keyword in matcher.iter(text_lower)} if matcher else set()
+    return {k for k in _IMPROVE_KEYWORDS.get(section, ()) if k in text_lower}
+
+
 # ============================================
 # HTTP Request Handler
 # ============================================
 
+# Constant response bodies, encoded once
+_ROOT_JSON = _dumps({
+    "name": "SR&ED Report AI Server",
+    "version": "1.0.0",
+    "endpoints": {
+        "GET  /health": "Server and model status",
+        "GET  /feedback": "Get all stored feedback",
+        "POST /generate": "Generate T661 descriptions",
+        "POST /generate/stream": "Stream generated T661 text as it is produced",
+        "POST /improve": "Improve existing T661 text",
+        "POST /feedback": "Submit paragraph feedback",
+        "POST /feedback/export": "Export feedback as DPO/SFT training data",
+    },
+})
+
+
 class SREDHandler(BaseHTTPRequestHandler):
+    # Keep connections open between requests and don't delay small responses
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    timeout = 60  # close idle keep-alive connections
+
     def do_OPTIONS(self):
         self.send_response(200)
         self._set_cors_headers()
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
     def do_GET(self):
-        parsed = urlparse(self.path)
-
-        if parsed.path == "/health":
-            feedback_count = count_feedback()
-            self._send_json({
-                "status": "ok",
-                "model_loaded": model_loaded,
-                "model_error": model_error,
-                "mode": "ai" if model_loaded else "template",
-                "feedback_count": feedback_count,
-                "trained_count": feedback_count,
-            })
-        elif parsed.path == "/feedback":
-            self._handle_get_feedback()
-        elif parsed.path == "/":
-            self._send_json({
-                "name": "SR&ED Report AI Server",
-                "version": "1.0.0",
-                "endpoints": {
-                    "GET  /health": "Server and model status",
-                    "GET  /feedback": "Get all stored feedback",
-                    "POST /generate": "Generate T661 descriptions",
-                    "POST /improve": "Improve existing T661 text",
-                    "POST /feedback": "Submit paragraph feedback",
-                    "POST /feedback/export": "Export feedback as DPO/SFT training data",
-                },
-            })
+        handler = _ROUTES_GET.get(self.path.partition("?")[0])
+        if handler:
+            handler(self)
         else:
             self._send_json({"error": "Not found"}, 404)
 
     def do_POST(self):
-        parsed = urlparse(self.path)
-        content_length = int(self.headers.get("Content-Length", 0))
-        body = self.rfile.read(content_length).decode("utf-8")
+        try:
+            content_length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            content_length = -1
+        if content_length < 0:
+            # The body can't be skipped, so the connection can't be reused
+            self.close_connection = True
+            self._send_json({"error": "Invalid Content-Length"}, 400)
+            return
+        if content_length > MAX_BODY_BYTES:
+            self.close_connection = True
+            self._send_json({"error": "Request body too large"}, 413)
+            return
+        body = self._read_body(content_length)
 
         try:
-            data = json.loads(body) if body else {}
-        except json.JSONDecodeError:
+            data = _loads(body) if body else {}
+        except ValueError:
             self._send_json({"error": "Invalid JSON"}, 400)
             return
 
-        if parsed.path == "/generate":
-            self._handle_generate(data)
-        elif parsed.path == "/improve":
-            self._handle_improve(data)
-        elif parsed.path == "/feedback":
-            self._handle_submit_feedback(data)
-        elif parsed.path == "/feedback/export":
-            self._handle_export_feedback()
+        handler = _ROUTES_POST.get(self.path.partition("?")[0])
+        if handler:
+            handler(self, data)
         else:
             self._send_json({"error": "Not found"}, 404)
 
+    def _handle_root(self):
+        self._send_bytes(_ROOT_JSON)
+
+    def _handle_health(self):
+        """Server and model status."""
+        feedback_count = count_feedback()
+        self._send_json({
+            "status": "ok",
+            "model_loaded": model_loaded,
+            "model_error": model_error,
+            "mode": "ai" if model_loaded else "template",
+            "feedback_count": feedback_count,
+            "trained_count": feedback_count,
+        })
+
+    def _read_body(self, content_length):
+        """Read the request body straight into a preallocated buffer."""
+        buf = bytearray(content_length)
+        received = 0
+        with memoryview(buf) as view:
+            while received < content_length:
+                n = self.rfile.readinto(view[received:])
+                if not n:
+                    break
+                received += n
+        if received < content_length:
+            del buf[received:]  # client closed early
+        return buf
+
     def _handle_generate(self, data):
         """Generate T661 descriptions from project details."""
         try:
@@ -352,6 +936,53 @@ class SREDHandler(BaseHTTPRequestHandler):
         except Exception as e:
             self._send_json({"error": str(e)}, 500)
 
+    def _handle_generate_stream(self, data):
+        """Stream generated text back as it is produced (chunked on HTTP/1.1)."""
+        # Anything that fails before the headers go out still gets a JSON error
+        try:
+            if model_loaded:
+                chunks = submit_stream(
+                    build_generation_prompt(data),
+                    max_tokens=data.get("max_tokens", 2048),
+                    temperature=data.get("temperature", 0.7),
+                )
+                mode = "ai"
+            else:
+                chunks = ["\n\n".join(generate_with_templates(data).values())]
+                mode = "template"
+        except Exception as e:
+            self._send_json({"error": str(e)}, 500)
+            return
+
+        # Chunked encoding depends on what the client speaks, not on our protocol_version
+        chunked = self.request_version >= "HTTP/1.1"
+        self.send_response(200)
+        self._set_cors_headers()
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("X-SRED-Mode", mode)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            # HTTP/1.0: the body ends when the connection closes
+            self.close_connection = True
+        self.end_headers()
+
+        try:
+            for text in chunks:
+                if not text:
+                    continue
+                payload = text.encode("utf-8")
+                if chunked:
+                    payload = b"%x\r\n%s\r\n" % (len(payload), payload)
+                self.wfile.write(payload)
+                self.wfile.flush()
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except Exception as e:
+            # Headers are already sent, so all we can do is drop the connection
+            logger.info("[STREAM] Aborted: %s", e)
+            self.close_connection = True
+
     def _handle_improve(self, data):
         """Improve existing T661 text."""
         text = data.get("text", "")
@@ -364,7 +995,7 @@ class SREDHandler(BaseHTTPRequestHandler):
         try:
             if model_loaded:
                 prompt = f"Improve the following T661 Line {section} description to be more CRA-compliant. Fix any weak language, add missing required elements, and ensure proper SR&ED terminology is used. Keep the technical content accurate but strengthen the SR&ED compliance.\n\nOriginal text:\n{text}\n\nImproved version:"
-                improved = generate_with_model(prompt, max_tokens=2048, temperature=0.5)
+                improved = submit_generation(prompt, max_tokens=2048, temperature=0.5)
                 self._send_json({"success": True, "mode": "ai", "improved": improved})
             else:
                 # Template-based improvement: add missing SR&ED phrases
@@ -376,39 +1007,18 @@ class SREDHandler(BaseHTTPRequestHandler):
     def _template_improve(self, text, section):
         """Basic template-based text improvement."""
         improvements = []
-        text_lower = text.lower()
-
-        if section == "242":
-            if "technological advancement" not in text_lower:
-                improvements.append("Consider adding: 'The technological advancement sought was...'")
-            if "standard practice" not in text_lower and "competent professional" not in text_lower:
-                improvements.append("Consider adding: 'This could not be achieved through standard practice because...'")
-            if "state of technology" not in text_lower and "baseline" not in text_lower:
-                improvements.append("Consider adding: 'At the outset of this project, the state of technology was...'")
-
-        elif section == "244":
-            if "it was uncertain" not in text_lower:
-                improvements.append("Frame uncertainties as: 'It was uncertain whether...'")
-            if "competent professional" not in text_lower:
-                improvements.append("Add: 'A competent professional could not resolve these through standard practice because...'")
-            if "hypothes" not in text_lower:
-                improvements.append("Consider adding hypotheses: 'H1: ...'")
-
-        elif section == "246":
-            if "systematic" not in text_lower:
-                improvements.append("Add: 'A systematic investigation was conducted...'")
-            if "experiment" not in text_lower and "test" not in text_lower:
-                improvements.append("Describe specific experiments and tests performed")
-            if "iteration" not in text_lower and "modif" not in text_lower:
-                improvements.append("Describe iterations/modifications made based on results")
-
-        result = text
+        hits = _find_improve_keywords(text.lower(), section)
+
+        for needles, message in _IMPROVE_RULES.get(section, ()):
+            if not any(n in hits for n in needles):
+                improvements.append(message)
+
+        parts = [text]
         if improvements:
-            result += "\n\n--- SUGGESTED IMPROVEMENTS ---\n"
-            for imp in improvements:
-                result += f"• {imp}\n"
+            parts.append("\n\n--- SUGGESTED IMPROVEMENTS ---\n")
+            parts.extend(f"• {imp}\n" for imp in improvements)
 
-        return result
+        return "".join(parts)
 
     def _handle_get_feedback(self):
         """Return all stored feedback."""
@@ -445,15 +1055,11 @@ class SREDHandler(BaseHTTPRequestHandler):
 
         total = count_feedback()
         feedback_type = entries[0].get("type", "paragraph")
-        print(f"[FEEDBACK] Received {len(entries)} {feedback_type} rating(s). Total stored: {total}")
+        logger.info("[FEEDBACK] Received %s %s rating(s). Total stored: %s", len(entries), feedback_type, total)
 
-        # Auto-export DPO/SFT training data on every feedback
-        try:
-            result = export_dpo_and_sft()
-            print(f"[AUTO-EXPORT] {result['dpo']} DPO pairs, {result['sft']} SFT examples")
-        except Exception as e:
-            print(f"[AUTO-EXPORT] Export failed: {e}")
-            result = {"dpo": 0, "sft": 0}
+        # Auto-export DPO/SFT training data in the background; report the last finished export
+        schedule_export()
+        result = last_export()
 
         self._send_json({
             "success": True,
@@ -462,11 +1068,12 @@ class SREDHandler(BaseHTTPRequestHandler):
             "trained_count": result.get("dpo", 0) + result.get("sft", 0)
         })
 
-    def _handle_export_feedback(self):
+    def _handle_export_feedback(self, data=None):
         """Export feedback as DPO and SFT training files."""
         try:
-            result = export_dpo_and_sft()
-            print(f"[EXPORT] Exported {result['dpo']} DPO pairs, {result['sft']} SFT examples")
+            with _export_lock:
+                result = export_dpo_and_sft()
+            logger.info("[EXPORT] Exported %s DPO pairs, %s SFT examples", result["dpo"], result["sft"])
             self._send_json({
                 "success": True,
                 "dpo_pairs": result["dpo"],
@@ -479,11 +1086,25 @@ class SREDHandler(BaseHTTPRequestHandler):
             self._send_json({"error": str(e)}, 500)
 
     def _send_json(self, data, status=200):
+        self._send_bytes(_dumps(data), status)
+
+    def _send_bytes(self, payload, status=200):
+        """Send an already-encoded JSON body."""
         self.send_response(status)
         self._set_cors_headers()
         self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode("utf-8"))
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("Connection", "close" if self.close_connection else "keep-alive")
+        if not hasattr(self, "_headers_buffer"):
+            # HTTP/0.9 request: send_header() wrote nothing, the response is just the body
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        # end_headers() would write the headers on their own; queue the blank line and the
+        # body behind them so the whole response goes out in one write
+        self._headers_buffer.append(b"\r\n")
+        self._headers_buffer.append(payload)
+        self.flush_headers()
 
     def _set_cors_headers(self):
         self.send_header("Access-Control-Allow-Origin", "*")
@@ -491,81 +1112,241 @@ class SREDHandler(BaseHTTPRequestHandler):
         self.send_header("Access-Control-Allow-Headers", "Content-Type")
 
     def log_message(self, format, *args):
-        print(f"[SRED-API] {args[0]} {args[1]} {args[2]}")
+        logger.info("[SRED-API] " + format, *args)
+
+
+# Path -> handler tables (query strings are ignored)
+_ROUTES_GET = {
+    "/": SREDHandler._handle_root,
+    "/health": SREDHandler._handle_health,
+    "/feedback": SREDHandler._handle_get_feedback,
+}
+_ROUTES_POST = {
+    "/generate": SREDHandler._handle_generate,
+    "/generate/stream": SREDHandler._handle_generate_stream,
+    "/improve": SREDHandler._handle_improve,
+    "/feedback": SREDHandler._handle_submit_feedback,
+    "/feedback/export": SREDHandler._handle_export_feedback,
+}
+
+
+class SREDServer(ThreadingHTTPServer):
+    """Threading server that can share its port with sibling worker processes."""
+    reuse_port = False
+
+    def server_bind(self):
+        if self.reuse_port:
+            # The kernel spreads incoming connections across every socket bound to the port
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+def _spawn_workers(count):
+    """Fork count-1 extra server processes. Returns this process's worker index (0 = parent)."""
+    if count > 1 and not (hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")):
+        print("WARNING: SRED_WORKERS needs fork and SO_REUSEPORT, running a single process")
+        count = 1
+    if count > 1 and _HAS_TORCH and os.path.exists(MODEL_PATH):
+        # Every worker would load its own copy of the model; on one GPU the extra copies
+        # fail to fit and those workers end up serving template mode instead
+        print("WARNING: SRED_WORKERS > 1 is only supported in template mode, running a single process")
+        count = 1
+    SREDServer.reuse_port = count > 1
+    sys.stdout.flush()  # don't let children inherit buffered output
+    for index in range(1, count):
+        if os.fork() == 0:
+            return index
+    return 0
 
 
 # ============================================
 # Feedback Storage & Export
 # ============================================
 
+# Feedback lives in SQLite (WAL mode), so counts and grouped exports are
+# queries and several server processes can share it safely. The raw JSON of
+# each entry is kept alongside the indexed columns.
+_FEEDBACK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS feedback (
+    id INTEGER PRIMARY KEY,
+    gen_id TEXT,
+    section TEXT,
+    type TEXT,
+    rating TEXT,
+    para_text TEXT,
+    word TEXT,
+    ts TEXT,
+    raw BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS feedback_gen_section ON feedback (gen_id, section);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB NOT NULL);
+"""
+_feedback_lock = threading.Lock()
+_feedback_db = None
+_feedback_db_pid = None
+
+
+def _column(value):
+    """Column value for a feedback field: strings as-is, anything else as its JSON text."""
+    if value is None or isinstance(value, str):
+        return value
+    return _dumps(value).decode("utf-8")
+
+
+def _feedback_row(entry):
+    fields = entry if isinstance(entry, dict) else {}
+    return (
+        _column(fields.get("genId", "")),
+        _column(fields.get("section", "")),
+        _column(fields.get("type", "paragraph")),
+        _column(fields.get("rating")),
+        _column(fields.get("paraText")),
+        _column(fields.get("word", "")),
+        _column(fields.get("timestamp")),
+        _dumps(entry),
+    )
+
+
+def _escape_surrogates(value):
+    """Replace lone surrogates (legal in JSON, not in UTF-8) with their backslash escape."""
+    if isinstance(value, str):
+        return value.encode("utf-8", "backslashreplace").decode("utf-8")
+    if isinstance(value, list):
+        return [_escape_surrogates(v) for v in value]
+    if isinstance(value, dict):
+        return {_escape_surrogates(k): _escape_surrogates(v) for k, v in value.items()}
+    return value
+
+
+def _bindable(row):
+    """Return row with its text columns escaped if SQLite can't bind them as UTF-8."""
+    try:
+        for value in row:
+            if isinstance(value, str):
+                value.encode("utf-8")
+        return row
+    except UnicodeEncodeError:
+        return tuple(_escape_surrogates(v) if isinstance(v, str) else v for v in row)
+
+
+_INSERT_FEEDBACK = "INSERT INTO feedback (gen_id, section, type, rating, para_text, word, ts, raw) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+
+
+def _migrate_feedback_jsonl(conn):
+    """One-time import of the old JSONL feedback log. The JSONL file is left in place."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+            rows = []
+            skipped = 0
+            if os.path.exists(FEEDBACK_FILE):
+                with open(FEEDBACK_FILE, "rb") as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            entry = _loads(line)
+                        except ValueError:
+                            try:
+                                # The old json.dumps log may hold lone surrogates, which orjson rejects
+                                entry = _escape_surrogates(json.loads(line))
+                            except ValueError:
+                                skipped += 1  # e.g. a line cut short by a crash mid-write
+                                continue
+                        rows.append(_bindable(_feedback_row(entry)))
+            conn.executemany(_INSERT_FEEDBACK, rows)
+            conn.execute("PRAGMA user_version = 1")
+            if rows or skipped:
+                logger.info("[FEEDBACK] Migrated %s entries from %s to %s (%s unreadable lines skipped)",
+                            len(rows), FEEDBACK_FILE, FEEDBACK_DB, skipped)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _get_feedback_db():
+    """Return this process's feedback database connection. Caller holds _feedback_lock."""
+    global _feedback_db, _feedback_db_pid
+    # Connections must not cross a fork, so each worker process opens its own
+    if _feedback_db is None or _feedback_db_pid != os.getpid():
+        os.makedirs(os.path.dirname(FEEDBACK_DB) or ".", exist_ok=True)
+        conn = sqlite3.connect(FEEDBACK_DB, timeout=30, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_FEEDBACK_SCHEMA)
+        _migrate_feedback_jsonl(conn)
+        _feedback_db, _feedback_db_pid = conn, os.getpid()
+    return _feedback_db
+
+
+def _close_feedback_db():
+    global _feedback_db
+    if _feedback_db is not None and _feedback_db_pid == os.getpid():
+        _feedback_db.close()
+    _feedback_db = None
+
+
+atexit.register(_close_feedback_db)
+
+
 def count_feedback():
-    """Count feedback entries in the file."""
-    if not os.path.exists(FEEDBACK_FILE):
-        return 0
-    with open(FEEDBACK_FILE, "r", encoding="utf-8") as f:
-        return sum(1 for line in f if line.strip())
+    """Count stored feedback entries."""
+    with _feedback_lock:
+        return _get_feedback_db().execute("SELECT COUNT(*) FROM feedback").fetchone()[0]
 
 
 def load_all_feedback():
-    """Load all feedback from file."""
-    if not os.path.exists(FEEDBACK_FILE):
-        return []
-    entries = []
-    with open(FEEDBACK_FILE, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                try:
-                    entries.append(json.loads(line))
-                except json.JSONDecodeError:
-                    pass
-    return entries
+    """Load all feedback in submission order."""
+    with _feedback_lock:
+        rows = _get_feedback_db().execute("SELECT raw FROM feedback ORDER BY id").fetchall()
+    return [_loads(raw) for raw, in rows]
 
 
 def append_feedback(entry):
-    """Append a single feedback entry to file."""
-    os.makedirs(os.path.dirname(FEEDBACK_FILE), exist_ok=True)
-    with open(FEEDBACK_FILE, "a", encoding="utf-8") as f:
-        f.write(json.dumps(entry) + "\n")
+    """Store a single feedback entry."""
+    row = _bindable(_feedback_row(entry))
+    with _feedback_lock:
+        _get_feedback_db().execute(_INSERT_FEEDBACK, row)
 
 
-def export_dpo_and_sft():
-    """Convert raw feedback into DPO pairs and SFT examples. Called automatically on every feedback."""
-    feedback = load_all_feedback()
-    if not feedback:
-        return {"dpo": 0, "sft": 0, "total": 0}
+def last_export():
+    """Counts from the most recent DPO/SFT export, shared by all worker processes."""
+    with _feedback_lock:
+        row = _get_feedback_db().execute("SELECT value FROM meta WHERE key = 'last_export'").fetchone()
+    return _loads(row[0]) if row else {"dpo": 0, "sft": 0, "total": 0}
 
-    # Separate paragraph and word feedback
-    para_feedback = [fb for fb in feedback if fb.get("type", "paragraph") != "word"]
-    word_feedback = [fb for fb in feedback if fb.get("type") == "word"]
 
-    # Group paragraph feedback by generation + section
-    groups = {}
-    for fb in para_feedback:
-        key = f"{fb.get('genId', '')}_{fb.get('section', '')}"
-        if key not in groups:
-            groups[key] = {"section": fb.get("section", ""), "fullText": fb.get("fullSectionText", ""), "items": []}
-        groups[key]["items"].append(fb)
-
-    # Collect bad words per section for context
-    bad_words_by_section = {}
-    for w in word_feedback:
-        key = f"{w.get('genId', '')}_{w.get('section', '')}"
-        if key not in bad_words_by_section:
-            bad_words_by_section[key] = []
-        bad_words_by_section[key].append(w.get("word", ""))
+def _save_last_export(result):
+    with _feedback_lock:
+        _get_feedback_db().execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_export', ?)", (_dumps(result),)
+        )
+
+
+def _write_replace(path, payload):
+    """Write payload to a temp file and rename it over path, so concurrent exports never interleave."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+
 
+_EXPORT_PROMPTS = {s: f"Write a T661 {s} description." for s in ("242", "244", "246")}
+
+_SFT_SYSTEM = "You are an expert SR&ED report writer specializing in CRA T661 form project descriptions."
+
+
+def export_dpo_and_sft():
+    """Convert raw feedback into DPO pairs and SFT examples. Called automatically on every feedback."""
     dpo_data = []
     sft_data = []
 
-    for gkey, group in groups.items():
-        up_paras = [i["paraText"] for i in group["items"] if i.get("rating") == "up"]
-        down_paras = [i["paraText"] for i in group["items"] if i.get("rating") == "down"]
-        bad_words = bad_words_by_section.get(gkey, [])
-
-        prompt_text = f"Write a T661 {group['section']} description."
+    def flush(section, up_paras, down_paras, bad_words):
+        prompt_text = _EXPORT_PROMPTS.get(section) or f"Write a T661 {section} description."
         if bad_words:
-            prompt_text += f" Avoid using these words/phrases: {', '.join(set(bad_words))}"
+            prompt_text += f" Avoid using these words/phrases: {', '.join(sorted(bad_words))}"
 
         if up_paras and down_paras:
             dpo_data.append({
@@ -576,25 +1357,89 @@ def export_dpo_and_sft():
         if up_paras:
             sft_data.append({
                 "conversations": [
-                    {"from": "system", "value": "You are an expert SR&ED report writer specializing in CRA T661 form project descriptions."},
+                    {"from": "system", "value": _SFT_SYSTEM},
                     {"from": "human", "value": prompt_text},
                     {"from": "gpt", "value": "\n\n".join(up_paras)},
                 ],
                 "source": "user_feedback_positive",
             })
 
+    # The (gen_id, section) index returns each generation + section as one
+    # contiguous run, so groups are built and flushed as the rows stream past
+    total = 0
+    with _feedback_lock:
+        rows = _get_feedback_db().execute(
+            "SELECT gen_id, section, type, rating, para_text, word FROM feedback ORDER BY gen_id, section, id"
+        )
+        key = None
+        has_paras = False
+        up_paras, down_paras, bad_words = [], [], set()
+        for gen_id, section, fb_type, rating, para_text, word in rows:
+            total += 1
+            if (gen_id, section) != key:
+                if has_paras:
+                    flush(key[1], up_paras, down_paras, bad_words)
+                key = (gen_id, section)
+                has_paras = False
+                up_paras, down_paras, bad_words = [], [], set()
+            if fb_type == "word":
+                bad_words.add(word)
+                continue
+            has_paras = True
+            if rating == "up":
+                up_paras.append(para_text)
+            elif rating == "down":
+                down_paras.append(para_text)
+        if has_paras:
+            flush(key[1], up_paras, down_paras, bad_words)
+
+    if not total:
+        result = {"dpo": 0, "sft": 0, "total": 0}
+        _save_last_export(result)
+        return result
+
     # Write files
     os.makedirs(os.path.dirname(DPO_FILE), exist_ok=True)
 
-    with open(DPO_FILE, "w", encoding="utf-8") as f:
-        for d in dpo_data:
-            f.write(json.dumps(d) + "\n")
+    # One write per file instead of one per record
+    _write_replace(DPO_FILE, b"".join(_dumps(d) + b"\n" for d in dpo_data))
+    _write_replace(SFT_FILE, b"".join(_dumps(s) + b"\n" for s in sft_data))
+
+    result = {"dpo": len(dpo_data), "sft": len(sft_data), "total": total}
+    _save_last_export(result)
+    return result
 
-    with open(SFT_FILE, "w", encoding="utf-8") as f:
-        for s in sft_data:
-            f.write(json.dumps(s) + "\n")
 
-    return {"dpo": len(dpo_data), "sft": len(sft_data), "total": len(feedback)}
+# Background auto-export. The queue holds at most one pending request, so a
+# burst of feedback submissions collapses into a single export run.
+_export_queue = queue.Queue(maxsize=1)
+_export_lock = threading.Lock()
+_export_worker = None
+_export_worker_lock = threading.Lock()
+
+
+def _run_export_worker():
+    while True:
+        _export_queue.get()
+        try:
+            with _export_lock:
+                result = export_dpo_and_sft()
+            logger.info("[AUTO-EXPORT] %s DPO pairs, %s SFT examples", result["dpo"], result["sft"])
+        except Exception as e:
+            logger.info("[AUTO-EXPORT] Export failed: %s", e)
+
+
+def schedule_export():
+    """Ask the background worker to re-export DPO/SFT data (coalesces with a pending request)."""
+    global _export_worker
+    with _export_worker_lock:
+        if _export_worker is None:
+            _export_worker = threading.Thread(target=_run_export_worker, name="sred-export", daemon=True)
+            _export_worker.start()
+    try:
+        _export_queue.put_nowait(1)
+    except queue.Full:
+        pass
 
 
 # ============================================
@@ -607,8 +1452,17 @@ def main():
     print("SR&ED Report AI Server")
     print("=" * 50)
 
+    # Fork before any threads start
+    worker = _spawn_workers(WORKERS)
+    setup_logging()
+
     load_model()
 
+    if model_loaded:
+        # Through the queue, so the batch worker thread is the one warmed up
+        print("Warming up model...")
+        warm_up_model()
+
     if model_loaded:
         print(f"Mode: AI (fine-tuned model)")
     else:
@@ -618,21 +1472,25 @@ def main():
         print("The server will use structured templates for report generation.")
         print("To enable AI mode, train a model with Axolotl and set SRED_MODEL_PATH.")
 
-    print(f"\nStarting server on http://localhost:{PORT}")
-    print(f"Endpoints:")
-    print(f"  GET  /health           - Server status")
-    print(f"  GET  /feedback         - Get all feedback")
-    print(f"  POST /generate         - Generate T661 descriptions")
-    print(f"  POST /improve          - Improve existing text")
-    print(f"  POST /feedback         - Submit feedback from phone/browser")
-    print(f"  POST /feedback/export   - Export DPO/SFT training data")
-    print()
-    print(f"  To access from phone, run:")
-    print(f"    npx cloudflared tunnel --url http://localhost:{PORT}")
-    print(f"  Or use ngrok:")
-    print(f"    ngrok http {PORT}")
-
-    server = HTTPServer(("0.0.0.0", PORT), SREDHandler)
+    if worker == 0:
+        print(f"\nStarting server on http://localhost:{PORT}")
+        if SREDServer.reuse_port:
+            print(f"Workers: {WORKERS} processes sharing port {PORT}")
+        print(f"Endpoints:")
+        print(f"  GET  /health           - Server status")
+        print(f"  GET  /feedback         - Get all feedback")
+        print(f"  POST /generate         - Generate T661 descriptions")
+        print(f"  POST /generate/stream  - Stream generated text")
+        print(f"  POST /improve          - Improve existing text")
+        print(f"  POST /feedback         - Submit feedback from phone/browser")
+        print(f"  POST /feedback/export   - Export DPO/SFT training data")
+        print()
+        print(f"  To access from phone, run:")
+        print(f"    npx cloudflared tunnel --url http://localhost:{PORT}")
+        print(f"  Or use ngrok:")
+        print(f"    ngrok http {PORT}")
+
+    server = SREDServer(("0.0.0.0", PORT), SREDHandler)
 
     try:
         server.serve_forever()
@@ -0,0 +1,91 @@
+"""
+Tests for the SQLite feedback store: the one-time JSONL migration and export metadata.
+Run with: python -m unittest discover ai
+"""
+
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+
+def load_server(name, without_orjson=False):
+    """Import a fresh copy of server.py, optionally exercising the json fallback."""
+    saved = sys.modules.get("orjson")
+    if without_orjson:
+        sys.modules["orjson"] = None
+    try:
+        spec = importlib.util.spec_from_file_location(name, SERVER_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        if without_orjson:
+            if saved is None:
+                del sys.modules["orjson"]
+            else:
+                sys.modules["orjson"] = saved
+    return module
+
+
+class LegacyMigrationTest(unittest.TestCase):
+    without_orjson = False
+
+    def setUp(self):
+        self.server = load_server(f"server_{type(self).__name__}", self.without_orjson)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.server.FEEDBACK_FILE = os.path.join(self.tmp.name, "feedback.jsonl")
+        self.server.FEEDBACK_DB = os.path.join(self.tmp.name, "feedback.db")
+        self.addCleanup(self.tmp.cleanup)
+        self.addCleanup(self.server._close_feedback_db)
+
+        # What the old json.dumps-based log could contain: a lone surrogate
+        # (escaped, as json.dumps writes it) and a last line cut off mid-write
+        entries = [
+            {"type": "paragraph", "genId": "g1", "section": "242", "rating": "up", "paraText": "good \ud800 text"},
+            {"type": "paragraph", "genId": "g1", "section": "242", "rating": "down", "paraText": "bad text"},
+        ]
+        with open(self.server.FEEDBACK_FILE, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.write('{"type": "word", "genId": "g1", "sec')
+
+    def test_migrates_surrogates_and_skips_truncated_line(self):
+        self.assertEqual(self.server.count_feedback(), 2)
+        feedback = self.server.load_all_feedback()
+        self.assertEqual([f["rating"] for f in feedback], ["up", "down"])
+        self.assertIn("good", feedback[0]["paraText"])
+
+        # Migrated entries must still be servable by GET /feedback and exportable
+        self.server._dumps(feedback)
+        self.server.DPO_FILE = os.path.join(self.tmp.name, "dpo.jsonl")
+        self.server.SFT_FILE = os.path.join(self.tmp.name, "sft.jsonl")
+        self.assertEqual(self.server.export_dpo_and_sft(), {"dpo": 1, "sft": 1, "total": 2})
+
+    def test_migration_runs_once(self):
+        self.assertEqual(self.server.count_feedback(), 2)
+        self.server._close_feedback_db()
+        self.assertEqual(self.server.count_feedback(), 2)
+
+    def test_last_export_survives_restart(self):
+        self.server.DPO_FILE = os.path.join(self.tmp.name, "dpo.jsonl")
+        self.server.SFT_FILE = os.path.join(self.tmp.name, "sft.jsonl")
+        self.server.export_dpo_and_sft()
+
+        # A restarted (or sibling worker) process reads the same counts from the database
+        restarted = load_server(f"{self.server.__name__}_restarted", self.without_orjson)
+        restarted.FEEDBACK_FILE = self.server.FEEDBACK_FILE
+        restarted.FEEDBACK_DB = self.server.FEEDBACK_DB
+        self.addCleanup(restarted._close_feedback_db)
+        self.assertEqual(restarted.last_export(), {"dpo": 1, "sft": 1, "total": 2})
+
+
+class LegacyMigrationWithoutOrjsonTest(LegacyMigrationTest):
+    without_orjson = True
+
+
+if __name__ == "__main__":
+    unittest.main()